@@ -185,6 +185,10 @@ class NamingConvention:
     none = "None"
 
 
+# Set from the main window; when True the generated models carry a content hash column and a syncJSON loader.
+content_hashing = False
+
+
 def correctName(name):
     global naming_convention
     if " " in name:
@@ -218,6 +222,8 @@ class ConfigOption():
         self.key = key
         self.name = correctName(key.json_name)
         self.ignore_field = False  # True if key.field_type == FieldType.Json else
+        # Natural key fields identify existing rows when content hashing is enabled.
+        self.natural_key = False
         if key.field_type == FieldType.NestedObject:
             self.choices = [FieldType.NestedObject]
             self.handle_nested_choices = [
@@ -258,6 +264,8 @@ FindChildRecursively = QtCore.Qt.FindChildOption.FindChildrenRecursively
 TAB = chr(9)
 INDENT = TAB
 INDENT_2 = TAB*2
+INDENT_3 = TAB*3
+INDENT_4 = TAB*4
 
 
 class DjangoModelFunctionality():
@@ -267,14 +275,27 @@ class DjangoModelFunctionality():
         self.fields = []
         self.constructor_args = []
         self.referTo = []
+        # Set by DjangoGenerator once all mapped fields are known, so the names can't clash with them.
+        self.parent_model = None
+        self.parent_field = None
+        # Only used when content hashing is enabled.
+        self.natural_key = []
+        self.hash_field = None
+        self.position_field = None
+
+    def takenFieldNames(self):
+        names = [name for name, json_name in self.constructor_args]
+        if self.json_field:
+            names.append(jsonDataFieldName())
+        return names + [name for name in (self.parent_field, self.hash_field, self.position_field) if name]
 
     def addField(self, f):
         self.fields.append(f)
 
-    def JSONFieldConversion(self):
+    def JSONFieldConversion(self, indent=INDENT_2):
         if self.json_field:
             keys = ', '.join(map(lambda x: '"'+x+'"', self.json_keys))
-            return chr(9)*2+f"whitelisted_json = dict([(key,json_data[key]) for key in ({keys})])\n" if self.json_field != None else None
+            return indent+f"whitelisted_json = dict([(key,json_data[key]) for key in ({keys})])\n" if self.json_field != None else None
         else:
             return ""
 
@@ -293,17 +314,24 @@ class DjangoModelFunctionality():
         else:
             return ""
 
-    def conversionFunction(self):
+    def constructorCall(self):
         def makeArg(arg):
             name, json_name = arg
             return f"{name}=json_data[\"{json_name}\"]"
         paramCode = [makeArg(arg) for arg in self.constructor_args]
         if self.json_field:
-            paramCode += ["json_data=whitelisted_json"]
+            paramCode += [f"{jsonDataFieldName()}=whitelisted_json"]
+        if content_hashing:
+            hashed_keys = [json_name for name, json_name in self.constructor_args] + self.json_keys
+            hashed_keys = ''.join(map(lambda x: '"'+x+'",', hashed_keys))
+            paramCode += [f"{self.hash_field}=contentHash(json_data,({hashed_keys}))"]
         paramCode = ', '.join(paramCode)
+        return f"{self.modelName}({paramCode})"
+
+    def conversionFunction(self):
         output = "def fromJSON(json_data: dict,save=False):"+"\n" + \
             self.nestedModelFields() + self.JSONFieldConversion() + chr(9)*2
-        output += f"model_instance = MainModel({paramCode})\n"
+        output += f"model_instance = {self.constructorCall()}\n"
 
         output += chr(9)*2+"if save==True: model_instance.save()\n"
         if self.referTo:
@@ -312,11 +340,123 @@ class DjangoModelFunctionality():
             output += INDENT_2+"return model_instance\n"
         return output
 
+    def matchKey(self, row):
+        # Rows are matched by natural key, otherwise by position (under their parent for child models).
+        match_fields = [self.parent_field+"_id"] if self.parent_field else []
+        match_fields += self.matchFields()
+        return "("+''.join(map(lambda x: f"{row}.{x},", match_fields))+")"
+
+    def matchFields(self):
+        return self.natural_key if self.natural_key else [self.position_field]
+
+    def matchConstraint(self):
+        # Unique match key, which also indexes the per-parent lookup.
+        fields = ([self.parent_field] if self.parent_field else []) + self.matchFields()
+        fields = ', '.join(map(lambda x: '"'+x+'"', fields))
+        return INDENT+"class Meta:\n" + \
+            INDENT_2 + \
+            f"constraints = [models.UniqueConstraint(fields=[{fields}], name=\"{self.modelName.lower()}_match_key\")]\n"
+
+    def loadedFields(self):
+        # Changed rows are rebuilt from the input, so only the pk, hash and match key are read back.
+        fields = ["pk", self.hash_field] + ([self.parent_field] if self.parent_field else []) + self.matchFields()
+        return ', '.join(map(lambda x: '"'+x+'"', fields))
+
+    def existingRowsQuery(self):
+        # The top level snapshot covers the whole table, child rows are fetched per chunk of parents.
+        if self.parent_field:
+            return INDENT_2+"for parents in chunked([parent for parent, json_rows in groups]):\n" + \
+                INDENT_3+f"for row in {self.modelName}.objects.filter({self.parent_field}__in=parents).only({self.loadedFields()}):\n" + \
+                self.storeExistingRow(INDENT_4)
+        return INDENT_2+f"for row in {self.modelName}.objects.only({self.loadedFields()}):\n" + \
+            self.storeExistingRow(INDENT_3)
+
+    def storeExistingRow(self, indent):
+        # Only rows without a position can share a match key; the extra ones are stale.
+        return indent+f"if {self.matchKey('row')} in existing:\n" + \
+            indent+INDENT+f"stale.append(existing[{self.matchKey('row')}].pk)\n" + \
+            indent+f"existing[{self.matchKey('row')}] = row\n"
+
+    def syncFunction(self):
+        '''
+        Generates syncJSON, which writes only the rows whose content hash differs from the stored row.
+        The main model takes a list of json objects, child models take a list of (parent, json_rows) pairs.
+        '''
+        name = self.modelName
+        if self.parent_field:
+            output = "def syncJSON(groups: list):\n"
+        else:
+            # The whole import runs in one transaction so a failure can't leave children half synced.
+            output = "@transaction.atomic\n"+INDENT+"def syncJSON(json_rows: list):\n"
+            output += INDENT_2+"groups = [(None, json_rows)]\n"
+        output += INDENT_2+"instances = []\n"
+        output += INDENT_2+"for parent, json_rows in groups:\n"
+        output += INDENT_3+"for position, json_data in enumerate(json_rows):\n"
+        output += self.JSONFieldConversion(indent=INDENT_4)
+        output += INDENT_4+f"model_instance = {self.constructorCall()}\n"
+        if self.parent_field:
+            output += INDENT_4+f"model_instance.{self.parent_field} = parent\n"
+        if not self.natural_key:
+            output += INDENT_4+f"model_instance.{self.position_field} = position\n"
+        output += INDENT_4+"instances.append((model_instance, json_data))\n"
+        output += INDENT_2+"existing, stale = {}, []\n"
+        output += self.existingRowsQuery()
+        output += INDENT_2+"to_create, to_update, seen = [], [], set()\n"
+        if self.referTo:
+            child_groups = ', '.join(
+                map(lambda x: f"\"{x[0]}\": []", self.referTo))
+            output += INDENT_2+f"child_groups = {{{child_groups}}}\n"
+        output += INDENT_2+"for model_instance, json_data in instances:\n"
+        output += INDENT_3+f"match_key = {self.matchKey('model_instance')}\n"
+        output += INDENT_3+"if match_key in seen:\n"
+        output += INDENT_4 + \
+            f"raise ValueError(f\"Duplicate match key {{match_key}} in {name} snapshot\")\n"
+        output += INDENT_3+"seen.add(match_key)\n"
+        output += INDENT_3+"match = existing.get(match_key)\n"
+        output += INDENT_3+"if match is None:\n"
+        output += INDENT_4+"to_create.append(model_instance)\n"
+        output += INDENT_3 + \
+            f"elif match.{self.hash_field} != model_instance.{self.hash_field}:\n"
+        output += INDENT_4+"model_instance.pk = match.pk\n"
+        output += INDENT_4+"to_update.append(model_instance)\n"
+        output += INDENT_3+"else:\n"
+        output += INDENT_4+"model_instance = match\n"
+        for model_name, json_name, isArray in self.referTo:
+            # A missing or null nested value yields no child rows, so the stored child is deleted.
+            if isArray:
+                rows = f"json_data.get(\"{json_name}\") or []"
+            else:
+                rows = f"[json_data[\"{json_name}\"]] if json_data.get(\"{json_name}\") is not None else []"
+            output += INDENT_3 + \
+                f"child_groups[\"{model_name}\"].append((model_instance, {rows}))\n"
+        update_fields = [name for name, json_name in self.constructor_args]
+        if self.json_field:
+            update_fields.append(jsonDataFieldName())
+        update_fields.append(self.hash_field)
+        update_fields = ', '.join(map(lambda x: '"'+x+'"', update_fields))
+        output += INDENT_2+f"{name}.objects.bulk_create(to_create)\n"
+        output += INDENT_2+f"{name}.objects.bulk_update(to_update, [{update_fields}])\n"
+        # Rows that disappeared from the snapshot (or from their parent's snapshot) are removed.
+        output += INDENT_2 + \
+            "stale += [row.pk for match_key, row in existing.items() if match_key not in seen]\n"
+        output += INDENT_2+"for pks in chunked(stale):\n"
+        output += INDENT_3+f"{name}.objects.filter(pk__in=pks).delete()\n"
+        for model_name, json_name, isArray in self.referTo:
+            output += INDENT_2 + \
+                f"{model_name}.syncJSON(child_groups[\"{model_name}\"])\n"
+        return output
+
     def __str__(self):
         l = []
         for field in self.fields+([self.json_field] if self.json_field != None else []):
             l.append(f'{chr(9)}{field}\n')
-        return f"class {self.modelName}(models.Model):\n"+''.join(l)+chr(9)+self.conversionFunction()+"\n"
+        output = f"class {self.modelName}(models.Model):\n"+''.join(l)
+        if content_hashing:
+            output += self.matchConstraint()
+        output += chr(9)+self.conversionFunction()
+        if content_hashing:
+            output += chr(9)+self.syncFunction()
+        return output+"\n"
 
 
 class DjangoMainModel(DjangoModelFunctionality):
@@ -335,6 +475,32 @@ def jsonDataFieldName():
     return "jsonData" if naming_convention == NamingConvention.camelCase else "json_data"
 
 
+def contentHashFieldName():
+    return "contentHash" if naming_convention == NamingConvention.camelCase else "content_hash"
+
+
+def positionFieldName():
+    return "position"
+
+
+def uniqueFieldName(name, taken):
+    # Generated bookkeeping fields must not shadow a field mapped from the json.
+    candidate = name
+    suffix = 2
+    while candidate in taken:
+        candidate = f"{name}{suffix}"
+        suffix += 1
+    return candidate
+
+
+def parentFieldName(model_name):
+    # MainModel -> main_model / mainModel
+    parts = [part.lower() for part in re.findall('[A-Z][^A-Z]*', model_name)]
+    if naming_convention == NamingConvention.camelCase:
+        return parts[0]+''.join(map(lambda x: x.capitalize(), parts[1:]))
+    return '_'.join(parts)
+
+
 class DjangoGenerator():
     def makeField(self, key: Key, modelToAddTo):
         config = key.config_option
@@ -357,11 +523,7 @@ class DjangoGenerator():
         elif hasattr(config, "handle_nested_object_choice") and config.handle_nested_object_choice == NestedChoices.ForeignKey:
             additionalModel = AdditionalModel(
                 name=django_name.capitalize()+"Model")
-            if naming_convention == NamingConvention.camelCase:
-                field = "mainModel = models.ForeignKey(MainModel,on_delete=models.CASCADE)"
-            else:
-                field = "main_model = models.ForeignKey(MainModel,on_delete=models.CASCADE)"
-            additionalModel.addField(field)
+            additionalModel.parent_model = modelToAddTo.modelName
             modelToAddTo.referTo.append(
                 (additionalModel.modelName, json_name, key.field_type == FieldType.ObjectArray))
             self.additionalModels.append(additionalModel)
@@ -393,6 +555,8 @@ class DjangoGenerator():
                     f"Field type not accounted for {key.field_type}")
             modelToAddTo.addField(field)
             modelToAddTo.constructor_args.append((django_name, json_name))
+            if config.natural_key:
+                modelToAddTo.natural_key.append(django_name)
 
     def __init__(self, parse_tree: ParseTree):
         self.parse_tree = parse_tree
@@ -400,8 +564,40 @@ class DjangoGenerator():
         self.mainModel = DjangoMainModel()
         for key in self.parse_tree.keys:
             self.makeField(key, self.mainModel)
+        for model in self.additionalModels:
+            self.addParentField(model)
+        if content_hashing:
+            for model in [self.mainModel]+self.additionalModels:
+                self.addChangeDetectionFields(model)
+
+    def addParentField(self, model):
+        model.parent_field = uniqueFieldName(
+            parentFieldName(model.parent_model), model.takenFieldNames())
+        model.fields.insert(
+            0, f"{model.parent_field} = models.ForeignKey({model.parent_model},on_delete=models.CASCADE)")
+
+    def addChangeDetectionFields(self, model):
+        # Nullable so rows saved through fromJSON, which has no position, don't violate the match key constraint.
+        if not model.natural_key:
+            model.position_field = uniqueFieldName(
+                positionFieldName(), model.takenFieldNames())
+            model.addField(
+                f"{model.position_field} = models.IntegerField(null=True)")
+        # 128 bit blake2b digest of the canonical json of the mapped fields, as hex.
+        model.hash_field = uniqueFieldName(
+            contentHashFieldName(), model.takenFieldNames())
+        model.addField(
+            f"{model.hash_field} = models.CharField(max_length=32,null=False)")
 
     def import_code(self):
+        if content_hashing:
+            return 'import hashlib\nimport json\nfrom django.db import models\nfrom django.db import transaction' + '\n'*2 + \
+                "def contentHash(json_data: dict, json_keys):\n" + \
+                INDENT+"canonical = json.dumps(dict([(key,json_data.get(key)) for key in json_keys]),sort_keys=True,separators=(\",\",\":\"))\n" + \
+                INDENT+"return hashlib.blake2b(canonical.encode(),digest_size=16).hexdigest()\n\n" + \
+                "def chunked(values: list, size=900):\n" + \
+                INDENT+"# Keeps IN lists below SQLite's limit on query parameters.\n" + \
+                INDENT+"return [values[i:i+size] for i in range(0, len(values), size)]\n"
         return 'from django.db import models'
 
     def __str__(self):
@@ -455,12 +651,21 @@ class MainWindow(QDialog):
             box.layout().addWidget(button)
         return box
 
+    def makeChangeDetectionInput(self):
+        box = QGroupBox("Re-import")
+        box.setLayout(QHBoxLayout())
+        self.contentHashInput = QCheckBox(
+            "Skip unchanged rows (content hash)")
+        box.layout().addWidget(self.contentHashInput)
+        return box
+
     def paramaterBox(self):
         paramaterBox = QGroupBox("Parameters")
         layout = QVBoxLayout()
         layout.addWidget(self.makeFileInput())
         layout.addWidget(self.makeFileOutput())
         layout.addWidget(self.makeSyleInput())
+        layout.addWidget(self.makeChangeDetectionInput())
         paramaterBox.setLayout(layout)
         return paramaterBox
 
@@ -476,6 +681,8 @@ class MainWindow(QDialog):
         global naming_convention
         naming_convention = [x.text() for x in self.findChildren(
             QRadioButton) if x.isChecked()][0]
+        global content_hashing
+        content_hashing = self.contentHashInput.isChecked()
         #self.alertError("file not found.")
         try:
             with open(file, errors='ignore') as f:
@@ -559,6 +766,9 @@ class ConfigurationWindow(QDialog):
 
         def handleIgnoreField(status):
             config.ignore_field = status
+
+        def handleNaturalKey(status):
+            config.natural_key = status
         config: ConfigOption = key.config_option
         layout = QFormLayout()
         entryWidget = QGroupBox(key.json_name)
@@ -572,6 +782,11 @@ class ConfigurationWindow(QDialog):
         allowNull.setChecked(config.allow_null_values)
         layout.addRow("allow null", allowNull)
         layout.addRow("type", makeTypePicker())
+        if content_hashing and config.field_type not in (FieldType.NestedObject, FieldType.ObjectArray, FieldType.PrimitiveArray, FieldType.Json):
+            naturalKey = QCheckBox()
+            naturalKey.setChecked(config.natural_key)
+            naturalKey.clicked.connect(handleNaturalKey)
+            layout.addRow("natural key", naturalKey)
 
         def makeNumInput():
             widget = QLineEdit()